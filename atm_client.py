@@ -4,10 +4,14 @@
 # Serena Geroe
 
 import socket
+import time
+import uuid
 
 HOST = "127.0.0.1"      # The bank server's IP address
 PORT = 65432            # The port used by the bank server
 RESULT_CODES = ['SUCCESS','INVALID LOGIN','INVALID AMOUNT','ATTEMPTED OVERDRAFT','SUSPICIOUS LOGIN']
+RETRY_ATTEMPTS = 3      # times a deposit / withdrawal is retried after the connection drops
+RETRY_DELAY = 1.0       # seconds to wait before each reconnection attempt
 
 ##########################################################
 #                                                        #
@@ -84,51 +88,52 @@ def get_login_info():
     pin = input("Please enter your four digit PIN: ")
     return acct_num, pin
 
-def get_acct_balance(sock, acct_num):
-    """Returns the account balance from the server."""
+def get_acct_balance(sock, acct_num, pin):
+    """Returns the account balance from the server, and the (possibly reconnected) socket."""
     client_msg = "b," + acct_num
-    send_to_server(sock, client_msg) # send the login_info concatenated string to the server
-    server_response = get_from_server(sock)
-    server_response_list = server_response.split(",")
-    bal = server_response_list[1]
-    return bal
+    _, bal, sock = communicate_with_retry(sock, client_msg, acct_num, pin)
+    return bal, sock
 
-def process_deposit(sock, acct_num):
-    """Returns result code and balance after successfully depositing money into account."""
-    bal = get_acct_balance(sock, acct_num)
+def new_request_id():
+    """Returns a fresh request ID, used by the server to recognize a retried deposit or withdrawal."""
+    return uuid.uuid4().hex
+
+def process_deposit(sock, acct_num, pin):
+    """Returns result code, balance, and the (possibly reconnected) socket after depositing money into account."""
+    bal, sock = get_acct_balance(sock, acct_num, pin)
     amt = input(f"How much would you like to deposit? (You have '${bal}' available)\n")
 
     if amountIsValid(amt):
         amt = float(amt)
 
-        client_msg = "d," + acct_num + "," + str(amt)
-        result_code, bal = communicateWithServer(sock, client_msg)
+        client_msg = "d," + acct_num + "," + str(amt) + "," + new_request_id()
+        result_code, bal, sock = communicate_with_retry(sock, client_msg, acct_num, pin)
 
         print("Deposit transaction completed.")
-        return result_code, bal
+        return result_code, bal, sock
     
     else:
         # amount is invalid:
-        return 2, bal # invalid amount
+        return 2, bal, sock # invalid amount
 
-def process_withdrawal(sock, acct_num):
-    """Returns result code and balance after successfully withdrawing money into account."""
+def process_withdrawal(sock, acct_num, pin):
+    """Returns result code, balance, and the (possibly reconnected) socket after withdrawing money from account."""
 
-    bal = get_acct_balance(sock, acct_num)
+    bal, sock = get_acct_balance(sock, acct_num, pin)
     amt = input(f"How much would you like to withdraw? (You have ${bal} available)\n")
 
     if amountIsValid(amt):
         amt = float(amt)
 
-        client_msg = "w," + acct_num + "," + str(amt)
-        result_code, bal = communicateWithServer(sock, client_msg)
+        client_msg = "w," + acct_num + "," + str(amt) + "," + new_request_id()
+        result_code, bal, sock = communicate_with_retry(sock, client_msg, acct_num, pin)
 
         print("Withdrawal transaction completed.")
-        return result_code, bal
+        return result_code, bal, sock
     
     else:
         # amount is invalid:
-        return 2, bal # invalid amount
+        return 2, bal, sock # invalid amount
 
 def communicateWithServer(sock, client_msg):
     """Returns result code and balance. Sends messages to the server and receives the server's response."""
@@ -139,8 +144,41 @@ def communicateWithServer(sock, client_msg):
     bal = server_response_list[1]
     return result_code, bal
 
-def process_customer_transactions(sock, acct_num):
-    """Ask customer for a transaction, communicate with server."""
+def reconnect_to_server(acct_num, pin):
+    """Returns a new socket logged in to acct_num. The server only releases the old session's login once it
+    notices the dropped connection, so a rejected login is retried a few times before giving up."""
+    for _ in range(RETRY_ATTEMPTS):
+        time.sleep(RETRY_DELAY)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((HOST, PORT))
+            result_code, _ = login_to_server(sock, acct_num, pin)
+            if result_code == 0:
+                return sock
+        except (OSError, ValueError, IndexError):
+            pass
+        sock.close()
+    raise ConnectionError("unable to reconnect to the banking server")
+
+def communicate_with_retry(sock, client_msg, acct_num, pin):
+    """Returns result code, balance, and the socket used. Like communicateWithServer, but if the connection drops
+    the client reconnects, logs in again, and resends the same message. Deposits and withdrawals must carry a
+    request ID so the server replays its original reply rather than applying the transaction twice."""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            result_code, bal = communicateWithServer(sock, client_msg)
+            return result_code, bal, sock
+        except (OSError, ValueError, IndexError):
+            # an empty or partial response means the server went away mid-request
+            sock.close()
+            if attempt == RETRY_ATTEMPTS - 1:
+                break
+            print("Lost connection to the banking server, retrying...")
+            sock = reconnect_to_server(acct_num, pin)
+    raise ConnectionError("unable to complete transaction with the banking server")
+
+def process_customer_transactions(sock, acct_num, pin):
+    """Ask customer for a transaction, communicate with server. Returns the socket in use when the customer exits."""
     while True:
         print("Select a transaction. Enter 'd' to deposit, 'w' to withdraw, 'b' to check balance, or 'x' to exit.")
         req = input("Your choice? ").lower()
@@ -154,17 +192,19 @@ def process_customer_transactions(sock, acct_num):
             # if customer wants to exit, break out of the loop
             break
         elif req == 'd':
-            result_code, bal = process_deposit(sock, acct_num)
+            result_code, bal, sock = process_deposit(sock, acct_num, pin)
         elif req == 'w':
-            result_code, bal = process_withdrawal(sock, acct_num)
+            result_code, bal, sock = process_withdrawal(sock, acct_num, pin)
         else: # req == 'b'
-            bal = get_acct_balance(sock, acct_num)
+            bal, sock = get_acct_balance(sock, acct_num, pin)
             print("You have " + bal + " available.")
 
         # print errors
         if str(result_code) != "0":
             print(RESULT_CODES[int(result_code)])
 
+    return sock
+
 def run_atm_core_loop(sock):
     """ Given an active network connection to the bank server, run the core business loop. """
 
@@ -191,7 +231,9 @@ def run_atm_core_loop(sock):
         print(RESULT_CODES[int(result_code)])
         return False
 
-    process_customer_transactions(sock, acct_num)
+    # a dropped connection may have been replaced during the session, so close whichever socket is current
+    sock = process_customer_transactions(sock, acct_num, pin)
+    sock.close()
 
     print("ATM session terminating.")
 
@@ -3,13 +3,30 @@
 # Bank Server application
 # Serena Geroe
 
+import json
+import os
+import signal
 import socket
 import selectors
+import struct
+import sys
+import time
+from collections import OrderedDict
 
 HOST = "127.0.0.1"      # Standard loopback interface address (localhost)
 PORT = 65432            # Port to listen on (non-privileged ports are > 1023)
 ALL_ACCOUNTS = dict()   # initialize an empty dictionary
 ACCT_FILE = "accounts.txt"
+REQUEST_CACHE_SIZE = 1024   # most request IDs remembered for replaying duplicate deposits / withdrawals
+REQUEST_CACHE_TTL = 300     # seconds a request ID is remembered before it can be evicted
+SNAPSHOT_INTERVAL = None    # seconds between periodic snapshots of ALL_ACCOUNTS (e.g. 60); None disables them
+SNAPSHOT_FILE = "accounts_snapshot.txt"  # where snapshots are written; a name ending in ".bin" selects the binary format
+SNAPSHOT_SIGNAL_CHECK = 1.0 # most seconds before the loop notices a SIGUSR1 snapshot request
+SNAPSHOT_MAGIC = b"BNK1"    # header of binary snapshot files
+SNAPSHOT_RECORD = struct.Struct("<8s4sd")  # binary record: account number, pin, balance
+CAPTURE_FILE = None         # set to a path (e.g. "capture.jsonl") to record client traffic for replay_traffic.py;
+                            # captures hold account numbers and PINs in plain text, so treat them like ACCT_FILE
+CAPTURE_FLUSH_INTERVAL = 1.0  # most seconds of captured traffic held in memory before it is written out
 
 ##########################################################
 #                                                        #
@@ -190,12 +207,273 @@ def load_all_accounts(acct_file = "accounts.txt"):
     print("finished loading account data")
     return True
 
+def load_binary_accounts(acct_file):
+    """ Load all accounts into the in-memory database from a binary snapshot written by write_binary_snapshot. """
+    print(f"loading account data from binary snapshot: {acct_file}")
+    with open(acct_file, "rb") as f:
+        data = f.read()
+    records = data[len(SNAPSHOT_MAGIC):]
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        print(f"ERROR: {acct_file} is not a binary account snapshot - IGNORED")
+        return False
+    if len(records) % SNAPSHOT_RECORD.size != 0:
+        print(f"ERROR: {acct_file} is truncated or corrupt - IGNORED")
+        return False
+    for num, pin, bal in SNAPSHOT_RECORD.iter_unpack(records):
+        # struct pads short fields with null bytes
+        load_account(num.rstrip(b"\x00").decode('utf-8'), pin.rstrip(b"\x00").decode('utf-8'), str(bal))
+    print("finished loading account data")
+    return True
+
+##########################################################
+#                                                        #
+# Bank Server Snapshots                                  #
+#                                                        #
+##########################################################
+
+def write_text_snapshot(f):
+    """ Write every account in ALL_ACCOUNTS to the open binary file f, in the same format as accounts.txt. """
+    lines = ["# Bank Account Records for bank server\n",
+             "# Data is provided as comma-separated values.\n",
+             "# Columns are: account number, pin, balance\n"]
+    for acct in ALL_ACCOUNTS.values():
+        lines.append(f"{acct.acct_number}, {acct.acct_pin}, {acct.acct_balance:.2f}\n")
+    f.write("".join(lines).encode('utf-8'))
+
+def write_binary_snapshot(f):
+    """ Write every account in ALL_ACCOUNTS to the open binary file f as fixed-size SNAPSHOT_RECORD entries. """
+    f.write(SNAPSHOT_MAGIC)
+    for acct in ALL_ACCOUNTS.values():
+        f.write(SNAPSHOT_RECORD.pack(acct.acct_number.encode('utf-8'), acct.acct_pin.encode('utf-8'), acct.acct_balance))
+
+def write_snapshot(path):
+    """ Write ALL_ACCOUNTS to path atomically: the data goes to a temporary file that is renamed over path once it
+    is safely on disk, so a reader never sees a half-written file. Returns the number of bytes written. """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            if path.endswith(".bin"):
+                write_binary_snapshot(f)
+            else:
+                write_text_snapshot(f)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, path)
+    except Exception:
+        # don't leave a partial temporary file behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    fsync_directory(os.path.dirname(os.path.abspath(path)))
+    return size
+
+def fsync_directory(dir_path):
+    """ Flush a directory entry to disk, so that a rename into it survives a crash. Not possible on Windows. """
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Snapshotter:
+    """Snapshotter instances checkpoint ALL_ACCOUNTS to disk without pausing the selector loop. Each snapshot
+    fork()s; the child serializes its copy-on-write view of the accounts and exits, while the parent only pays for
+    the fork itself and goes back to serving ATMs. Snapshots run every `interval` seconds and on SIGUSR1."""
+
+    def __init__(self, path, interval):
+        """ Initialize the snapshot schedule; interval None means on-demand only. No periodic snapshot is taken
+        until the first interval has passed. """
+        self.path = path
+        self.interval = interval
+        self.child_pid = None   # pid of the snapshot in progress, if any
+        self.next_due = None if interval is None else time.monotonic() + interval
+        self.requested = False  # set by the SIGUSR1 handler, acted on by poll()
+        self.signal_installed = False
+
+    def install_signal_handler(self):
+        """ Request an on-demand snapshot whenever the server receives SIGUSR1 (e.g. `kill -USR1 <pid>`).
+        The handler only sets a flag: forking inside it could catch an account halfway through a deposit. """
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.request)
+            self.signal_installed = True
+
+    def request(self, signum = None, frame = None):
+        """ Ask for a snapshot at the next safe point in the selector loop. """
+        self.requested = True
+
+    def select_timeout(self):
+        """ Return how long sel.select() may block before a snapshot could be due (None: forever). """
+        timeout = None if not self.signal_installed else SNAPSHOT_SIGNAL_CHECK
+        if self.next_due is not None:
+            until_due = max(0.0, self.next_due - time.monotonic())
+            timeout = until_due if timeout is None else min(timeout, until_due)
+        return timeout
+
+    def poll(self):
+        """ Called once per selector loop iteration, between requests: reap a finished snapshot and start a
+        requested or periodic one. """
+        self.reap()
+        if self.next_due is not None and time.monotonic() >= self.next_due:
+            self.next_due = time.monotonic() + self.interval
+            self.requested = True
+        if self.requested:
+            self.requested = False
+            self.start()
+
+    def start(self):
+        """ Begin a snapshot. Returns False if one is already running. """
+        self.reap()
+        if self.child_pid is not None:
+            print("Snapshot already in progress - request ignored\n")
+            return False
+        if not hasattr(os, "fork"):
+            # no fork() on this platform, so the loop has to wait for the whole dump
+            started = time.perf_counter()
+            size = write_snapshot(self.path)
+            print(f"Snapshot written to {self.path}: {size} bytes, parent paused {time.perf_counter() - started:.6f}s\n")
+            return True
+
+        started = time.perf_counter()
+        # flush first, or the child would write out its copy of any buffered log lines a second time
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.run_child()
+        self.child_pid = pid
+        print(f"Snapshot started in child {pid}, parent paused {time.perf_counter() - started:.6f}s\n")
+        return True
+
+    def run_child(self):
+        """ Runs in the forked child: write the snapshot, report it, and exit without returning to the server loop. """
+        exit_code = 1
+        try:
+            started = time.perf_counter()
+            size = write_snapshot(self.path)
+            print(f"Snapshot written to {self.path}: {size} bytes in {time.perf_counter() - started:.6f}s\n", flush=True)
+            exit_code = 0
+        except Exception as e:
+            print(f"Snapshot to {self.path} failed: {e}\n", flush=True)
+        finally:
+            os._exit(exit_code)
+
+    def reap(self):
+        """ Collect the snapshot child if it has finished, so it does not linger as a zombie. """
+        if self.child_pid is None:
+            return
+        pid, status = os.waitpid(self.child_pid, os.WNOHANG)
+        if pid == 0:
+            return
+        if os.waitstatus_to_exitcode(status) != 0:
+            print(f"Snapshot child {pid} exited with an error\n")
+        self.child_pid = None
+
 ##########################################################
 #                                                        #
 # Bank Server Network Operations                         #
 #                                                        #
 ##########################################################
 
+def requestIdIsValid(req_id):
+    """Return True if req_id represents a valid client request ID. A valid request ID is a string of 1 to 32
+    alphanumeric characters."""
+    return isinstance(req_id, str) and \
+        0 < len(req_id) <= 32 and \
+        req_id.isalnum()
+
+
+class RequestCache:
+    """RequestCache instances remember the replies sent for recent deposit and withdrawal request IDs, so that
+    a client retrying a request after a dropped connection gets the original reply instead of applying it twice.
+    Entries are evicted once they are older than ttl seconds, or oldest first once there are more than max_size."""
+
+    def __init__(self, max_size = REQUEST_CACHE_SIZE, ttl = REQUEST_CACHE_TTL):
+        """ Initialize an empty cache. """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict() # (acct_num, req_id) : (time stored, op, amount, result_code, balance), oldest first
+
+    def evict(self, now):
+        """ Drop entries that have expired, then the oldest entries until the cache fits in max_size. """
+        while self.entries:
+            stored_at = next(iter(self.entries.values()))[0]
+            if now - stored_at < self.ttl and len(self.entries) <= self.max_size:
+                break
+            self.entries.popitem(last=False)
+
+    def lookup(self, acct_num, req_id):
+        """ Return the cached (op, amount, result_code, balance) for this request, or None if it has not been seen
+        recently. """
+        self.evict(time.monotonic())
+        entry = self.entries.get((acct_num, req_id))
+        if entry is None:
+            return None
+        return entry[1:]
+
+    def store(self, acct_num, req_id, op, amount, result_code, bal):
+        """ Remember the request and the reply sent for it. """
+        now = time.monotonic()
+        self.entries[(acct_num, req_id)] = (now, op, amount, result_code, bal)
+        self.entries.move_to_end((acct_num, req_id))
+        self.evict(now)
+
+# one cache shared by every ATM session, like ALL_ACCOUNTS
+REQUEST_CACHE = RequestCache()
+
+
+class TrafficCapture:
+    """TrafficCapture instances append every client message and the server's reply to a JSONL file, one object
+    per line: {"run": server run ID, "ts": unix time, "session": session ID, "msg": client message,
+    "reply": server response}. Session IDs restart at 0 each time the server starts, so the run ID (pid and start
+    time) tells sessions from different runs apart. Messages are recorded verbatim, login PINs included, so the
+    file is created readable by its owner only.
+    Lines go through a large write buffer that the selector loop flushes within CAPTURE_FLUSH_INTERVAL seconds
+    of the first unwritten line, so capturing usually costs a json.dumps per message rather than a disk write."""
+
+    def __init__(self, path = None):
+        """ Open path for appending, or stay disabled if path is None. """
+        self.file = None
+        if path is not None:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            self.file = open(fd, "a", buffering=1 << 16, encoding="utf-8")
+        self.runID = f"{os.getpid()}-{int(time.time())}"
+        self.flush_due = None   # monotonic time by which buffered lines must be written, None if nothing is buffered
+
+    def record(self, sessionID, client_msg, response):
+        """ Append one request / reply pair to the capture, if capturing is enabled. """
+        if self.file is None:
+            return
+        self.file.write(json.dumps({"run": self.runID, "ts": time.time(), "session": sessionID,
+                                    "msg": client_msg, "reply": response}) + "\n")
+        if self.flush_due is None:
+            self.flush_due = time.monotonic() + CAPTURE_FLUSH_INTERVAL
+
+    def select_timeout(self):
+        """ Return how long sel.select() may block before buffered lines must be flushed (None: forever). """
+        if self.flush_due is None:
+            return None
+        return max(0.0, self.flush_due - time.monotonic())
+
+    def poll(self):
+        """ Called once per selector loop iteration: write out buffered lines once they are due. """
+        if self.flush_due is not None and time.monotonic() >= self.flush_due:
+            self.file.flush()
+            self.flush_due = None
+
+    def close(self):
+        """ Flush any buffered lines and close the capture file. """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.flush_due = None
+
+# opened in run_network_server so that importing this module never creates a capture file
+CAPTURE = TrafficCapture()
+
 def validate_acct_pin_pair(client_msg, state: CurrentState):
     """ Validate the account number - pin pair based on the memory database.
     Returns the result code and this BankAccount object.
@@ -238,14 +516,19 @@ def validate_acct_pin_pair(client_msg, state: CurrentState):
 # "Dispatch function"
 def interpret_client_operation(msg, thisState:CurrentState):
     """Parses client request, sends client account balance, performs request.
-    Result codes are: 0: valid result; 1: invalid login; 2: invalid amount; 3: attempted overdraft; 4: suspicious login""" 
+    Result codes are: 0: valid result; 1: invalid login; 2: invalid amount; 3: attempted overdraft; 4: suspicious login
+    Deposits and withdrawals may carry a fourth field, a client-generated request ID; a repeated request ID is
+    answered with the cached reply instead of being applied again.""" 
 
     go_ahead = False
 
-    op_list = msg.split(",") #op[0] = "l", "b", "d", or "w" | op[1] = param
+    op_list = msg.split(",") #op[0] = "l", "b", "d", or "w" | op[1] = param | op[3] = optional request ID for "d" and "w"
 
     # DO NOT ASSUME THAT A RECEIVED MESSAGE WILL CONTAIN DATA IN THE EXPECTED FORMAT
-    if (len(op_list) == 2 or len(op_list) == 3) and (all( isinstance( item, str ) for item in op_list) and (type(op_list[0]) == str) ):
+    if len(op_list) == 4:
+        if op_list[0] not in ("d", "w") or not requestIdIsValid(op_list[3]):
+            return 1, -1000 # only deposits and withdrawals carry a request ID
+    if (len(op_list) in (2, 3, 4)) and (all( isinstance( item, str ) for item in op_list) and (type(op_list[0]) == str) ):
 
         this_acct = get_acct(op_list[1])
 
@@ -275,13 +558,9 @@ def interpret_client_operation(msg, thisState:CurrentState):
                 # do not need to update the state
                 result_code = 0      
 
-            # deposit
-            elif(op_list[0] == "d"):
-                _, result_code, _ = this_acct.deposit(float(op_list[2]))
-
-            # withdraw
-            elif (op_list[0] == "w"):
-                _, result_code, _ = this_acct.withdraw(float(op_list[2]))
+            # deposit or withdrawal
+            elif(op_list[0] == "d" or op_list[0] == "w"):
+                return run_transaction(op_list, this_acct)
 
             else:
                 return 1, -1000 # nefarious client sending malformed request
@@ -294,6 +573,32 @@ def interpret_client_operation(msg, thisState:CurrentState):
 
     else: return 4, -1000 #result code is 1, report bal is -1000 since this is an invalid login!!    
 
+
+def run_transaction(op_list, this_acct):
+    """Performs a deposit or withdrawal and returns the result code and balance.
+    If the request carries a request ID that was already answered, the cached reply is returned and the
+    account is left untouched. Reusing a request ID for a different operation or amount is rejected as malformed."""
+    req_id = op_list[3] if len(op_list) == 4 else None
+    op, amount = op_list[0], float(op_list[2])
+
+    if req_id is not None:
+        cached = REQUEST_CACHE.lookup(this_acct.acct_number, req_id)
+        if cached is not None:
+            cached_op, cached_amount, result_code, bal = cached
+            if (cached_op, cached_amount) != (op, amount):
+                print(f"Request id {req_id} reused for a different transaction - rejected\n")
+                return 1, -1000
+            print(f"Replaying cached reply for request id {req_id}\n")
+            return result_code, bal
+
+    if op == "d":
+        _, result_code, bal = this_acct.deposit(amount)
+    else:
+        _, result_code, bal = this_acct.withdraw(amount)
+
+    if req_id is not None:
+        REQUEST_CACHE.store(this_acct.acct_number, req_id, op, amount, result_code, bal)
+    return result_code, bal
     
 def accept_wrapper(sock, sel, seshID):
     """ Initiates the connection between the server and client, and sets the connection to be non-blocking.
@@ -338,7 +643,11 @@ def service_connection(sel, key, mask, conn, addr):
     if mask & selectors.EVENT_READ:
    # receive the data from this register, in the form of a CurrentState object
 
-        recv_data = sock.recv(1024)  # Should be ready to read
+        try:
+            recv_data = sock.recv(1024)  # Should be ready to read
+        except ConnectionResetError:
+            # the client dropped the connection; treat it like a normal close so it can reconnect and retry
+            recv_data = b""
         # Note: DO NOT worry about the client sending too much data 
         print("Received client message: " + recv_data.decode('utf-8') + "\n")
         
@@ -347,11 +656,10 @@ def service_connection(sel, key, mask, conn, addr):
             print(f"Closing connection to session id {data.sessionID}\n")
             sel.unregister(sock)
             sock.close()
+            #remove this account number from the class variable before logging out, so a reconnecting client can log in again
+            if data.logged_in and CurrentState.ACCTS_LOGGED_IN.get(data.accountNumber) == data.sessionID:
+                CurrentState.ACCTS_LOGGED_IN.pop(data.accountNumber)
             data.logout()
-            #remove this account number from the class variable
-            if(len(CurrentState.ACCTS_LOGGED_IN) > 0):
-                if data.accountNumber in CurrentState.ACCTS_LOGGED_IN and data.logged_in == True:
-                    CurrentState.ACCTS_LOGGED_IN.pop(data.accountNumber)
             return
 
         # client_msg will be in string form because of the below line
@@ -373,12 +681,17 @@ def run_bank_operations(conn, addr, client_msg, thisState):
 
     print("Sending client response: " + response + "\n")
     conn.sendall( response.encode('utf-8') )
+    CAPTURE.record(thisState.sessionID, client_msg, response)
 
 
 def run_network_server():
     """ Runs the communication between the server and the client. """
+    global CAPTURE
 
     sessionID = 0
+    CAPTURE = TrafficCapture(CAPTURE_FILE)
+    snapshotter = Snapshotter(SNAPSHOT_FILE, SNAPSHOT_INTERVAL)
+    snapshotter.install_signal_handler()
 
     print("Establishing connection to client - listening for connections at IP", HOST, "and port", PORT, " \n")
      
@@ -405,7 +718,9 @@ def run_network_server():
                 # see more details at https://realpython.com/python-sockets/#handling-multiple-connections
                 
                 # below line is configured by sel.register line above 
-                events = sel.select(timeout=None) #blocks until there are sockets ready for I/O, i.e. have events ready to be processed
+                # blocks until there are sockets ready for I/O, i.e. have events ready to be processed, or a snapshot or capture flush is due
+                timeouts = [t for t in (snapshotter.select_timeout(), CAPTURE.select_timeout()) if t is not None]
+                events = sel.select(timeout=min(timeouts) if timeouts else None)
                 for key, mask in events:
                     #listening socket, need to accept the connection (i.e. new incoming client connxn, ready to be accepted)
                     if key.data is None: #returns third argument of object passed into sel.reg (data)
@@ -418,12 +733,15 @@ def run_network_server():
                         # print("after service: " + str(conn) + "," + str(addr))
                 # increment session ID, which will be the next unused value of session ID
                 sessionID = sessionID + 1
+                snapshotter.poll()
+                CAPTURE.poll()
 
         except KeyboardInterrupt as e: # if user hits delete or CTRL+C
             print("Caught keyboard interrupt, exiting\n")
             print(f"{e}") # Print the error
         finally:
-            sel.close()    
+            sel.close()
+            CAPTURE.close()
 
 ##########################################################
 #                                                        #
@@ -477,7 +795,10 @@ def demo_bank_server():
 if __name__ == "__main__":
     """ This function loads all bank accounts and runs the main network server function. """
     # on startup, load all the accounts from the account file
-    load_all_accounts(ACCT_FILE)
+    if ACCT_FILE.endswith(".bin"):
+        load_binary_accounts(ACCT_FILE)
+    else:
+        load_all_accounts(ACCT_FILE)
     # uncomment the next line in order to run a simple demo of the server in action
     # demo_bank_server()
     run_network_server()
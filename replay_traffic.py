@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+#
+# Traffic replay tool for the bank server.
+# Re-drives a capture written by bank_server.py (see CAPTURE_FILE) against a running server.
+#
+# Start the server from the same accounts file the capture began with, with capturing turned off, or the replayed
+# balances will diverge. A capture holds every message verbatim, including login PINs, so keep it as private as
+# accounts.txt.
+
+import argparse
+import json
+import socket
+import threading
+import time
+from collections import defaultdict
+
+HOST = "127.0.0.1"      # The bank server's IP address
+PORT = 65432            # The port used by the bank server
+OP_NAMES = {'l': 'login', 'b': 'balance', 'd': 'deposit', 'w': 'withdraw'}
+MAX_SESSIONS = 256      # most sessions replayed at once, each on its own thread and connection
+
+##########################################################
+#                                                        #
+# Capture Loading                                        #
+#                                                        #
+##########################################################
+
+def load_capture(capture_file):
+    """ Read a JSONL capture and return a dictionary of session label : list of (ts, msg, reply), each list in
+    time order. Session IDs restart with every server run, so sessions are keyed by run ID and session ID.
+    Lines that are not valid capture records are reported and skipped. """
+    sessions = defaultdict(list)
+    with open(capture_file, "r", encoding="utf-8") as f:
+        for line_num, line in enumerate(f, 1):
+            try:
+                record = json.loads(line)
+                label = f"{record.get('run', '-')}/{record['session']}"
+                sessions[label].append((float(record["ts"]), record["msg"], record["reply"]))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                print(f"ERROR: invalid capture record on line {line_num} - IGNORED")
+    for records in sessions.values():
+        records.sort(key=lambda record: record[0])
+    return sessions
+
+def session_accounts(records):
+    """ Return the set of account numbers a session's messages refer to. """
+    return {msg.split(",")[1] for _, msg, _ in records if len(msg.split(",")) > 1}
+
+def plan_session_order(sessions):
+    """ Return a dictionary of session label : labels of the sessions it must wait for. A session waits for every
+    earlier session on one of its accounts that had already finished when it started in the capture, so that
+    replaying faster than real time cannot reorder logins and balance changes on a shared account.
+    Sessions that overlapped in the capture are left to overlap again. """
+    predecessors = {}
+    recent = defaultdict(list)  # account : sessions a later session on this account may need to wait for
+    for label in sorted(sessions, key=lambda label: sessions[label][0][0]):
+        first_ts = sessions[label][0][0]
+        waits = set()
+        for acct in session_accounts(sessions[label]):
+            finished = [other for other in recent[acct] if sessions[other][-1][0] <= first_ts]
+            waits.update(finished)
+            # waiting for this session now implies waiting for everything it waits for
+            recent[acct] = [other for other in recent[acct] if other not in finished] + [label]
+        predecessors[label] = waits
+    return predecessors
+
+##########################################################
+#                                                        #
+# Replay                                                 #
+#                                                        #
+##########################################################
+
+class ReplayResults:
+    """ReplayResults instances collect per-op latencies and divergences from every replayed session.
+    Sessions run in their own threads, so all updates go through a lock."""
+
+    def __init__(self):
+        """ Initialize empty results. """
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)  # op name : list of round-trip times in seconds
+        self.divergences = []               # (session, msg, captured reply, replayed reply)
+        self.errors = []                    # (session, error message)
+
+    def add_reply(self, session, msg, op, latency, expected, actual):
+        """ Record one request's latency, and a divergence if the reply differs from the captured one. """
+        with self.lock:
+            self.latencies[op].append(latency)
+            if expected != actual:
+                self.divergences.append((session, msg, expected, actual))
+
+    def add_error(self, session, error):
+        """ Record a session that could not be replayed to the end. """
+        with self.lock:
+            self.errors.append((session, str(error)))
+
+
+def wait_until(start, delay):
+    """ Sleep until delay seconds after the monotonic time start. """
+    remaining = start + delay - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+
+def close_session(sock):
+    """ Close a replayed session and wait until the server has seen the close, so that the account's login is
+    released before a later session on the same account logs in. """
+    sock.shutdown(socket.SHUT_WR)
+    sock.settimeout(5.0)
+    while sock.recv(1024):
+        pass
+
+def replay_session(session, records, capture_start, replay_start, speed, waits, done, slots, results):
+    """ Replay one captured session over its own connection, once the sessions it waits for are done. Each message
+    is sent at its captured offset from the start of the capture divided by speed, or as fast as possible when
+    speed is 0. Releases its slot in slots when finished. """
+    try:
+        for event in waits:
+            event.wait()
+        with socket.create_connection((HOST, PORT)) as sock:
+            for ts, msg, expected in records:
+                if speed > 0:
+                    wait_until(replay_start, (ts - capture_start) / speed)
+                sent_at = time.perf_counter()
+                sock.sendall(msg.encode('utf-8'))
+                actual = sock.recv(1024).decode('utf-8')
+                latency = time.perf_counter() - sent_at
+                results.add_reply(session, msg, OP_NAMES.get(msg.split(",")[0], "other"), latency, expected, actual)
+            close_session(sock)
+    except OSError as e:
+        results.add_error(session, e)
+    finally:
+        done.set()
+        slots.release()
+
+def replay_capture(sessions, speed, max_sessions = MAX_SESSIONS):
+    """ Replay the sessions concurrently, keeping the captured order of sessions that share an account, and
+    return the ReplayResults and the total wall-clock time. Each session's thread is only started when the session
+    is due to begin, and at most max_sessions run at once, so a long capture does not need a thread per session. """
+    results = ReplayResults()
+    predecessors = plan_session_order(sessions)
+    done = {session: threading.Event() for session in sessions}
+    slots = threading.BoundedSemaphore(max_sessions)
+    capture_start = min(records[0][0] for records in sessions.values())
+    replay_start = time.monotonic()
+    # predecessors always start earlier, so a session waiting for a free slot never blocks the ones it waits for
+    for session in sorted(sessions, key=lambda session: sessions[session][0][0]):
+        records = sessions[session]
+        if speed > 0:
+            wait_until(replay_start, (records[0][0] - capture_start) / speed)
+        slots.acquire()
+        threading.Thread(target=replay_session,
+                         args=(session, records, capture_start, replay_start, speed,
+                               [done[other] for other in predecessors[session]], done[session], slots, results)).start()
+    for event in done.values():
+        event.wait()
+    return results, time.monotonic() - replay_start
+
+##########################################################
+#                                                        #
+# Reporting                                              #
+#                                                        #
+##########################################################
+
+def percentile(sorted_values, fraction):
+    """ Return the value at the given fraction (0.0 - 1.0) of an already sorted, non-empty list. """
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def describe_divergence(expected, actual):
+    """ Return a short description of which parts of a server reply (result code, balance) differ from the captured reply. """
+    expected_list = expected.split(",")
+    actual_list = actual.split(",")
+    if len(expected_list) != 2 or len(actual_list) != 2:
+        return "malformed reply"
+    parts = []
+    if expected_list[0] != actual_list[0]:
+        parts.append("result code")
+    if expected_list[1] != actual_list[1]:
+        parts.append("balance")
+    return " and ".join(parts) + (" differ" if len(parts) > 1 else " differs")
+
+def print_report(results, elapsed):
+    """ Print per-op latency statistics, divergences, and session errors. """
+    total = sum(len(latencies) for latencies in results.latencies.values())
+    print(f"Replayed {total} requests in {elapsed:.3f}s")
+    print(f"{'op':<10}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for op, latencies in sorted(results.latencies.items()):
+        latencies.sort()
+        print(f"{op:<10}{len(latencies):>8}{1000 * sum(latencies) / len(latencies):>10.3f}"
+              f"{1000 * percentile(latencies, 0.50):>10.3f}{1000 * percentile(latencies, 0.95):>10.3f}"
+              f"{1000 * latencies[-1]:>10.3f}")
+
+    print(f"{len(results.divergences)} divergent replies")
+    for session, msg, expected, actual in results.divergences:
+        print(f"  session {session}: '{msg}' captured '{expected}', replayed '{actual}' "
+              f"({describe_divergence(expected, actual)})")
+
+    for session, error in results.errors:
+        print(f"  session {session} stopped early: {error}")
+
+##########################################################
+#                                                        #
+# Replay Startup Operations                              #
+#                                                        #
+##########################################################
+
+def parse_speed(value):
+    """ Parse the --speed option: a positive multiplier such as 1 or 10, or 'max' to send without pauses. """
+    if value == "max":
+        return 0.0
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a bank server traffic capture and report latency and divergences. "
+                                     "Start the server from the same accounts file the capture began with, with capturing "
+                                     "turned off, or balances will diverge. Captures contain login PINs in plain text.")
+    parser.add_argument("capture_file", help="JSONL capture written by bank_server.py")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="replay speed multiplier, or 'max' (default: 1)")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS,
+                        help=f"most sessions replayed at once (default: {MAX_SESSIONS})")
+    parser.add_argument("--host", default=HOST, help=f"bank server address (default: {HOST})")
+    parser.add_argument("--port", type=int, default=PORT, help=f"bank server port (default: {PORT})")
+    args = parser.parse_args()
+    if args.max_sessions < 1:
+        parser.error("--max-sessions must be at least 1")
+    HOST, PORT = args.host, args.port
+
+    sessions = load_capture(args.capture_file)
+    if not sessions:
+        print("Capture is empty - nothing to replay")
+    else:
+        print(f"Replaying {len(sessions)} sessions from {args.capture_file}")
+        results, elapsed = replay_capture(sessions, args.speed, args.max_sessions)
+        print_report(results, elapsed)
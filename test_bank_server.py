@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+#
+# Tests for the bank server and ATM client, run against a real server process.
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import atm_client
+import bank_server
+import replay_traffic
+
+SERVER_SCRIPT = "import bank_server as b; b.PORT = {port}; {setup}; b.load_all_accounts(b.ACCT_FILE); b.run_network_server()"
+
+
+def free_port():
+    """ Return a TCP port on the loopback interface that nothing is listening on. """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((atm_client.HOST, 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, setup = "pass", stdout = subprocess.DEVNULL):
+    """ Start a bank server on port, running the Python statement setup first, and wait until it is listening.
+    Output is block-buffered, as it is when a real server's log goes to a file. """
+    env = {name: value for name, value in os.environ.items() if name != "PYTHONUNBUFFERED"}
+    server = subprocess.Popen([sys.executable, "-c", SERVER_SCRIPT.format(port=port, setup=setup)],
+                              stdout=stdout, stderr=subprocess.DEVNULL, env=env)
+    for _ in range(50):
+        try:
+            socket.create_connection((atm_client.HOST, port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return server
+
+
+@pytest.fixture
+def server_port(monkeypatch):
+    """ Run a bank server on a free port for the duration of one test, and point atm_client at it. """
+    port = free_port()
+    server = start_server(port)
+    try:
+        monkeypatch.setattr(atm_client, "PORT", port)
+        monkeypatch.setattr(atm_client, "RETRY_DELAY", 0.1)
+        yield port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def login(port, acct_num, pin):
+    """ Return a socket to the server logged in to acct_num. """
+    sock = socket.create_connection((atm_client.HOST, port))
+    result_code, _ = atm_client.login_to_server(sock, acct_num, pin)
+    assert result_code == 0
+    return sock
+
+
+def test_dropped_deposit_is_applied_once_after_retry(server_port):
+    sock = login(server_port, "ac-12345", "1324")
+    start_bal, sock = atm_client.get_acct_balance(sock, "ac-12345", "1324")
+
+    # send the deposit, then drop the connection without reading the reply
+    client_msg = "d,ac-12345,10.0," + atm_client.new_request_id()
+    atm_client.send_to_server(sock, client_msg)
+    time.sleep(0.2)
+    sock.close()
+
+    # the retry reconnects, logs in again, and resends the same request ID
+    result_code, bal, sock = atm_client.communicate_with_retry(sock, client_msg, "ac-12345", "1324")
+    assert result_code == 0
+    assert float(bal) == round(float(start_bal) + 10.0, 2)
+
+    end_bal, sock = atm_client.get_acct_balance(sock, "ac-12345", "1324")
+    assert float(end_bal) == round(float(start_bal) + 10.0, 2)
+    sock.close()
+
+
+def test_closed_session_releases_login(server_port):
+    login(server_port, "bc-01373", "2947").close()
+    time.sleep(0.2)
+    login(server_port, "bc-01373", "2947").close()
+
+
+@pytest.fixture
+def accounts(monkeypatch):
+    """ Give each test its own empty in-memory account database. """
+    monkeypatch.setattr(bank_server, "ALL_ACCOUNTS", dict())
+    return bank_server.ALL_ACCOUNTS
+
+
+def test_binary_snapshot_round_trip(accounts, tmp_path):
+    bank_server.load_account("ac-12345", "1324", "1024.32")
+    bank_server.load_account("bc-01373", "2947", "45.72")
+    path = str(tmp_path / "accounts.bin")
+    bank_server.write_snapshot(path)
+
+    accounts.clear()
+    assert bank_server.load_binary_accounts(path)
+    assert {num: (acct.acct_pin, acct.acct_balance) for num, acct in accounts.items()} == \
+        {"ac-12345": ("1324", 1024.32), "bc-01373": ("2947", 45.72)}
+
+
+def test_truncated_binary_snapshot_is_rejected(accounts, tmp_path):
+    bank_server.load_account("ac-12345", "1324", "1024.32")
+    path = tmp_path / "accounts.bin"
+    bank_server.write_snapshot(str(path))
+    path.write_bytes(path.read_bytes()[:-3])
+
+    accounts.clear()
+    assert not bank_server.load_binary_accounts(str(path))
+    assert accounts == {}
+
+
+def wait_for_snapshot(path, expected_line):
+    """ Poll until the snapshot at path contains expected_line, and return its lines. """
+    for _ in range(50):
+        if path.exists() and expected_line in path.read_text().splitlines():
+            break
+        time.sleep(0.1)
+    return path.read_text().splitlines()
+
+
+def test_periodic_snapshot_matches_balances_while_serving(tmp_path):
+    snapshot_file = tmp_path / "snapshot.txt"
+    port = free_port()
+    server = start_server(port, f"b.SNAPSHOT_FILE = {str(snapshot_file)!r}; b.SNAPSHOT_INTERVAL = 0.3")
+    try:
+        sock = login(port, "ac-12345", "1324")
+        assert atm_client.communicateWithServer(sock, "d,ac-12345,10.0")[0] == 0
+        # keep the server busy across several snapshots; every request must still be answered
+        deadline = time.monotonic() + 1.0
+        while time.monotonic() < deadline:
+            assert atm_client.communicateWithServer(sock, "b,ac-12345") == (0, "1034.32")
+        sock.close()
+        assert "ac-12345, 1324, 1034.32" in wait_for_snapshot(snapshot_file, "ac-12345, 1324, 1034.32")
+        assert not [name for name in os.listdir(tmp_path) if ".tmp" in name]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_sigusr1_snapshot_does_not_duplicate_the_log(accounts, tmp_path):
+    snapshot_file = tmp_path / "snapshot.bin"
+    log_file = tmp_path / "server.log"
+    port = free_port()
+    with open(log_file, "w") as log:
+        # Ctrl+C shutdown, so the server exits normally and writes out its buffered log
+        server = start_server(port, f"b.SNAPSHOT_FILE = {str(snapshot_file)!r}; "
+                                    "import signal; signal.signal(signal.SIGINT, signal.default_int_handler)", stdout=log)
+    try:
+        sock = login(port, "bc-01373", "2947")
+        assert atm_client.communicateWithServer(sock, "d,bc-01373,1.0")[0] == 0
+        server.send_signal(signal.SIGUSR1)
+        for _ in range(50):
+            if snapshot_file.exists():
+                break
+            time.sleep(0.1)
+        assert atm_client.communicateWithServer(sock, "b,bc-01373") == (0, "46.72")
+        sock.close()
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+    assert bank_server.load_binary_accounts(str(snapshot_file))
+    assert bank_server.get_balance("bc-01373") == 46.72
+    assert log_file.read_text().count("loaded account 'bc-01373'") == 1
+
+
+def test_capture_is_flushed_while_idle_and_replays_in_order(tmp_path, monkeypatch):
+    capture_file = tmp_path / "capture.jsonl"
+    port = free_port()
+    server = start_server(port, f"b.CAPTURE_FILE = {str(capture_file)!r}; b.CAPTURE_FLUSH_INTERVAL = 0.2")
+    try:
+        # two back-to-back sessions on the same account
+        for amount in ("10.0", "20.0"):
+            sock = login(port, "ac-12345", "1324")
+            atm_client.communicateWithServer(sock, f"d,ac-12345,{amount},{atm_client.new_request_id()}")
+            sock.close()
+            time.sleep(0.2)
+        time.sleep(0.5)
+        # the server is idle and still running, so these lines were written by the timed flush
+        assert len(capture_file.read_text().splitlines()) == 4
+    finally:
+        server.terminate()
+        server.wait()
+
+    sessions = replay_traffic.load_capture(str(capture_file))
+    assert len(sessions) == 2
+    first, second = sorted(sessions, key=lambda label: sessions[label][0][0])
+    assert replay_traffic.plan_session_order(sessions) == {first: set(), second: {first}}
+
+    port = free_port()
+    server = start_server(port)
+    try:
+        monkeypatch.setattr(replay_traffic, "PORT", port)
+        results, _ = replay_traffic.replay_capture(sessions, 0.0)
+        assert results.divergences == [] and results.errors == []
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def test_replay_bounds_concurrent_sessions(accounts, monkeypatch):
+    bank_server.load_all_accounts(bank_server.ACCT_FILE)
+    accts = sorted(accounts)
+    # 700 one-message sessions, so many that they would not all fit at once
+    sessions = {f"run/{i}": [(float(i), f"b,{accts[i % len(accts)]}", f"0,{accounts[accts[i % len(accts)]].acct_balance}")]
+                for i in range(700)}
+
+    peak = [0]
+    finished = threading.Event()
+    def count_threads():
+        while not finished.is_set():
+            peak[0] = max(peak[0], threading.active_count())
+            time.sleep(0.001)
+    sampler = threading.Thread(target=count_threads)
+
+    port = free_port()
+    server = start_server(port)
+    try:
+        monkeypatch.setattr(replay_traffic, "PORT", port)
+        sampler.start()
+        results, _ = replay_traffic.replay_capture(sessions, 0.0, max_sessions=20)
+    finally:
+        finished.set()
+        sampler.join()
+        server.terminate()
+        server.wait()
+    assert results.errors == [] and results.divergences == []
+    assert sum(len(latencies) for latencies in results.latencies.values()) == 700
+    # the main thread and the sampler, plus at most 20 replay sessions
+    assert peak[0] <= 20 + 2
+
+
+def test_load_capture_keeps_runs_apart(tmp_path):
+    capture_file = tmp_path / "capture.jsonl"
+    capture_file.write_text(
+        '{"run": "1-100", "ts": 1.0, "session": 0, "msg": "l,ac-12345,1324", "reply": "0,1024.32"}\n'
+        '{"run": "2-200", "ts": 5.0, "session": 0, "msg": "l,ac-12345,1324", "reply": "0,1024.32"}\n'
+        'not json\n')
+    sessions = replay_traffic.load_capture(str(capture_file))
+    assert sorted(sessions) == ["1-100/0", "2-200/0"]
+
+
+def test_reused_request_id_for_a_different_transaction_is_rejected(accounts, monkeypatch):
+    monkeypatch.setattr(bank_server, "REQUEST_CACHE", bank_server.RequestCache())
+    bank_server.load_account("ac-12345", "1324", "1024.32")
+    acct = bank_server.get_acct("ac-12345")
+
+    assert bank_server.run_transaction(["d", "ac-12345", "10.0", "r1"], acct) == (0, 1034.32)
+    assert bank_server.run_transaction(["d", "ac-12345", "10.0", "r1"], acct) == (0, 1034.32)
+    assert bank_server.run_transaction(["w", "ac-12345", "500.0", "r1"], acct) == (1, -1000)
+    assert bank_server.run_transaction(["d", "ac-12345", "20.0", "r1"], acct) == (1, -1000)
+    assert acct.acct_balance == 1034.32